@@ -1,52 +1,57 @@
 from __future__ import annotations
 
+import array
 import functools
-from dataclasses import dataclass
+import math
+import re
+
+# the slot DP stops being interactive somewhere past 2^this states
+MAX_DP_STATES_LOG2 = 20
+
+# groups: (u)int size, bytesN size, fixed-size type name; anything ending in [] is a dynamic array
+_TYPE_RE = re.compile(r'u?int(\d*)|bytes(\d+)|(bool|address|byte|bytes|string)|.+\[\]')
+_FIXED_TYPE_BITS = {'bool': 8, 'address': 160, 'byte': 8, 'bytes': 256, 'string': 256}
+# one `type name;` declaration, with any surrounding whitespace
+_DECLARATION_RE = re.compile(r'\s*([^\s;]+)\s+([^\s;]+)\s*;')
 
 
-@dataclass()
 class Variable:
-    type: str
-    name: str
+    __slots__ = ('type', 'name', 'num_bits')
+
+    def __init__(self, type: str, name: str):
+        self.type = type
+        self.name = name
+        self.num_bits: int = self._parse_num_bits()
 
     def __repr__(self):
         return f'{self.type} {self.name}'
 
-    @property
-    def num_bits(self):
-        if self.type[-2:] == '[]':
-            return 256
-        if self.type == 'bool':
-            return 8
-        if self.type[:4] == 'uint':
-            size = self.type[4:]
-            if len(size) == 0:
-                return 256
-            assert size.isdigit()
-            return int(size)
-        if self.type[:3] == 'int':
-            size = self.type[3:]
-            if len(size) == 0:
-                return 256
-            assert size.isdigit()
-            return int(size)
-        if self.type == 'address':
-            return 160
-        if self.type == 'byte':
-            return 8
-        if self.type == 'bytes':
-            return 256
-        if self.type[:5] == 'bytes':
-            size = self.type[5:]
-            assert size.isdigit()
-            return int(size) * 8
-        if self.type == 'string':
-            return 256
-        assert False
+    def __eq__(self, other: Variable):
+        if not isinstance(other, Variable):
+            return NotImplemented
+        return (self.type, self.name) == (other.type, other.name)
+
+    def _parse_num_bits(self):
+        match = _TYPE_RE.fullmatch(self.type)
+        assert match
+        int_size, bytes_size, fixed_type = match.groups()
+        if int_size is not None:
+            return int(int_size) if int_size else 256
+        if bytes_size is not None:
+            return int(bytes_size) * 8
+        if fixed_type is not None:
+            return _FIXED_TYPE_BITS[fixed_type]
+        # dynamic array
+        return 256
 
 
 @functools.total_ordering
 class VariablesPermutation(tuple[Variable]):
+    def __new__(cls, variables=()):
+        self = super().__new__(cls, variables)
+        self._names = tuple(var.name for var in self)
+        return self
+
     @property
     def num_slots(self):
         num_slots = 0
@@ -61,49 +66,206 @@ class VariablesPermutation(tuple[Variable]):
         return num_slots
 
     def __eq__(self, other: VariablesPermutation):
-        if len(self) != len(other):
-            return False
-        for i in range(len(self)):
-            if self[i].name != other[i].name:
-                return False
-        return True
+        return self._names == _names_of(other)
 
     def __lt__(self, other: VariablesPermutation):
-        for i in range(min(len(self), len(other))):
-            if self[i].name < other[i].name:
+        return self._names < _names_of(other)
+
+
+def _names_of(variables) -> tuple[str, ...]:
+    # permutations carry their names already, but any other sequence of Variables compares too
+    if isinstance(variables, VariablesPermutation):
+        return variables._names
+    return tuple(var.name for var in variables)
+
+
+_SWEEP_HEADER = '''
+def sweep(min_dp, max_dp, {sizes}):
+    # adding a variable only ever increases the index, so increasing order visits every multiset before its supersets
+    for index in range(len(min_dp)):
+        min_state = min_dp[index]
+        max_state = max_dp[index]
+        # both outcomes of adding a variable are fixed per index: it either lands on top of the current slot's fill,
+        # or `(state | 511) + 1` moves on to an empty new slot; only the select depends on the variable
+        min_room = 256 - (min_state & 511)
+        max_room = 256 - (max_state & 511)
+        min_new_slot = (min_state | 511) + 1
+        max_new_slot = (max_state | 511) + 1'''
+
+_SWEEP_TRANSITION = '''
+        if index // {stride} % {radix} != {count}:
+            state = (min_new_slot if size{c} > min_room else min_state) + size{c}
+            if state < min_dp[index + {stride}]:
+                min_dp[index + {stride}] = state
+            state = (max_new_slot if size{c} > max_room else max_state) + size{c}
+            if state > max_dp[index + {stride}]:
+                max_dp[index + {stride}] = state'''
+
+
+def class_strides(counts: list[int]) -> list[int]:
+    """Mixed-radix place value of each size class, for indexing multisets that take up to `counts[c]` of class c."""
+    strides = [1] * len(counts)
+    for c in range(1, len(counts)):
+        strides[c] = strides[c - 1] * (counts[c - 1] + 1)
+    return strides
+
+
+@functools.cache
+def _compile_sweep(counts: tuple[int, ...]):
+    """
+    Generate the DP sweep for size classes with `counts` variables each, with the loop over classes unrolled so each
+    transition has its stride and count inlined as constants and its size in a local.
+    """
+    source = _SWEEP_HEADER.format(sizes=', '.join(f'size{c}' for c in range(len(counts))))
+    source += ''.join(_SWEEP_TRANSITION.format(c=c, stride=stride, radix=count + 1, count=count)
+                      for c, (stride, count) in enumerate(zip(class_strides(list(counts)), counts)))
+    namespace = {}
+    exec(source, namespace)
+    return namespace['sweep']
+
+
+def slot_tables(sizes: list[int], counts: list[int]) -> tuple[array.array, array.array]:
+    """
+    DP over sub-multisets of variables, scoring every ordering of every sub-multiset in one sweep. Variables of equal
+    bit size are interchangeable as far as slots go, so they're grouped into classes of `counts[c]` variables of size
+    `sizes[c]`, and a sub-multiset taking `taken[c]` of each class lives at index `sum(taken[c] * class_strides[c])`.
+    For each sub-multiset, the first table holds the fewest slots any ordering of it packs into along with the smallest
+    last-slot fill reaching that count, and the second table holds the most slots along with the largest last-slot
+    fill. Entries are encoded as `slots << 9 | fill` so that comparing them as plain ints orders them by slots, then
+    fill.
+    """
+    num_states = math.prod(count + 1 for count in counts)
+    min_dp = array.array('i', [(sum(counts) + 1) << 9]) * num_states
+    max_dp = array.array('i', [0]) * num_states
+    min_dp[0] = max_dp[0] = 256
+    _compile_sweep(tuple(counts))(min_dp, max_dp, *sizes)
+    return min_dp, max_dp
+
+
+def _first_min_ordering(sizes: list[int], strides: list[int], min_table: array.array, min_slots: int):
+    """
+    Depth-first search in index order for the first ordering of `sizes` packing into `min_slots` slots. `strides` holds
+    each variable's class stride into `min_table`. Returns the ordering as a list of indices, or None if there isn't
+    one.
+    """
+    full_mask = (1 << len(sizes)) - 1
+    full_index = len(min_table) - 1
+    # the ordering under construction, as indices into `sizes`
+    order = [0] * len(sizes)
+    # fewest slots each (used sizes, current slot fill) state has been entered with; only the sizes left matter for
+    # finishing, so once a state fails, entering it again with as many slots or more fails too
+    seen = {}
+
+    def bb(used_mask, used_index, cur_size, slots):
+        # iterative, since structs of repeated types can run to thousands of variables; each frame holds a state on
+        # the path and the index to resume its loop from, and `order[k]` holds the child taken from frame k
+        stack = []
+        while True:
+            # enter (used_mask, used_index, cur_size, slots)
+            if used_mask == full_mask:
                 return True
-            if self[i].name > other[i].name:
+            key = (used_index, cur_size)
+            if seen.get(key, len(sizes) + 1) > slots:
+                seen[key] = slots
+                stack.append([used_mask, used_index, cur_size, slots, set(), 0])
+            # move to the next child of the deepest frame with one left, backtracking out of exhausted frames
+            while stack:
+                frame = stack[-1]
+                used_mask, used_index, cur_size, slots, tried, start = frame
+                for i in range(start, len(sizes)):
+                    var_size = sizes[i]
+                    # swapping equal-size variables can't change slots, so only the first unused one of each size
+                    # can win
+                    if used_mask & (1 << i) or var_size in tried:
+                        continue
+                    tried.add(var_size)
+                    if cur_size + var_size > 256:
+                        new_slots, new_size = slots + 1, var_size
+                    else:
+                        new_slots, new_size = slots, cur_size + var_size
+                    # at best, the first slot of the remaining variables merges into the current one
+                    if new_slots + max(0, (min_table[full_index - used_index - strides[i]] >> 9) - 1) > min_slots:
+                        continue
+                    frame[5] = i + 1
+                    break
+                else:
+                    stack.pop()
+                    continue
+                break
+            else:
                 return False
-        return len(self) < len(other)
+            order[len(stack) - 1] = i
+            used_mask, used_index, cur_size, slots = used_mask | (1 << i), used_index + strides[i], new_size, new_slots
+
+    return order if bb(0, 0, 256, 0) else None
+
+
+def pack_variables(variables: list[Variable]) -> tuple[VariablesPermutation, int]:
+    """Find the alphabetically first permutation with the fewest slots, and the most slots any permutation uses."""
+    # everything past this works on indices into the name-sorted variables and their sizes
+    variables = sorted(variables, key=lambda var: var.name)
+    sizes = [var.num_bits for var in variables]
+    if len(sizes) < 2 or sum(sorted(sizes)[:2]) > 256:
+        # no two variables can share a slot, so every ordering takes one slot per variable
+        return VariablesPermutation(variables), len(variables)
+    class_sizes = sorted(set(sizes))
+    counts = [sizes.count(size) for size in class_sizes]
+    strides = dict(zip(class_sizes, class_strides(counts)))
+    var_strides = [strides[size] for size in sizes]
+    min_table, max_table = slot_tables(class_sizes, counts)
+    min_slots = min_table[-1] >> 9
+
+    # with the slot count known, the search only has to find the first ordering reaching it
+    order = _first_min_ordering(sizes, var_strides, min_table, min_slots)
+    return VariablesPermutation(variables[i] for i in order), max_table[-1] >> 9
+
+
+def parse_variables(source: str) -> list[Variable]:
+    """Parse semicolon-terminated `type name;` declarations. Anything after the last semicolon is ignored."""
+    variables = []
+    pos = 0
+    while match := _DECLARATION_RE.match(source, pos):
+        variables.append(Variable(*match.groups()))
+        pos = match.end()
+    assert ';' not in source[pos:], f'malformed declaration: {source[pos:].split(";")[0].strip()}'
+    return variables
+
+
+def num_dp_states(variables: list[Variable]) -> int:
+    """Number of states `slot_tables` needs for `variables`: one per sub-multiset of their bit sizes."""
+    sizes = [var.num_bits for var in variables]
+    return math.prod(sizes.count(size) + 1 for size in set(sizes))
 
 
 if __name__ == '__main__':
     def main():
         import argparse
-        import itertools
 
         parser = argparse.ArgumentParser(description='Optimally pack solidity variables')
         parser.add_argument('variables', type=str, help='semicolon- or comma-separated variables', nargs='*')
         parser.add_argument('--variables_file', '-f', type=str, help='file of semicolon- or comma-separated variables')
+        parser.add_argument('--force', action='store_true', help=f'allow more than 2^{MAX_DP_STATES_LOG2} DP states')
         args = parser.parse_args()
 
         if args.variables_file:
             if len(args.variables) != 0:
                 parser.error('Requires only one of: variables file or variables arguments')
             with open(args.variables_file, 'r', encoding='utf8') as file:
-                variables = [Variable(*var.strip().split(' ')) for var in file.read().split(';')[:-1]]
+                variables = parse_variables(file.read())
         elif len(args.variables) != 0:
-                variables = [Variable(*var.strip().split(' ')) for var in ' '.join(args.variables).split(';')[:-1]]
+                variables = parse_variables(' '.join(args.variables))
         else:
             parser.error('Requires only one of: variables file or variables arguments')
 
         # noinspection PyUnboundLocalVariable
-        permutations = [VariablesPermutation(permutation) for permutation in itertools.permutations(variables)]
-        max_slots = max(permutations, key=lambda p: p.num_slots).num_slots
-        min_slots = min(permutations, key=lambda p: p.num_slots).num_slots
-        permutations = sorted(filter(lambda p: p.num_slots == min_slots, permutations), reverse=True)
-        winning_order_function = ';\n'.join(str(var) for var in permutations[-1]) + ';'
-        winning_order_type = ','.join(str(var) for var in permutations[-1])
+        dp_states = num_dp_states(variables)
+        if dp_states > 1 << MAX_DP_STATES_LOG2 and not args.force:
+            parser.error(f'{len(variables)} variables would need {dp_states} DP states; '
+                         f'more than 2^{MAX_DP_STATES_LOG2} requires --force')
+        winner, max_slots = pack_variables(variables)
+        min_slots = winner.num_slots
+        winning_order_function = ';\n'.join(str(var) for var in winner) + ';'
+        winning_order_type = ','.join(str(var) for var in winner)
         print(f'original slots: {VariablesPermutation(variables).num_slots}   min slots: {min_slots}   '
               f'max slots: {max_slots}\n\n{winning_order_function}\n\n{winning_order_type}')
 
@@ -0,0 +1,46 @@
+import itertools
+import unittest
+
+from pack_struct import Variable, VariablesPermutation, pack_variables, parse_variables
+
+STRUCTS = [
+    'uint8 a; address b; uint256 c; bool d; uint128 e; uint64 f; bytes4 g;',
+    'uint8 z; uint16 y; address x; uint128 w; uint128 v; bool u; uint256 t;',
+    'bytes4 o; uint j; bytes v; address u; uint40 c; uint[] y; int24 n;',
+    'uint128 d; uint128 c; uint128 b; uint128 a; uint8 e;',
+    'address q; address p; uint96 r; uint96 s; bool t; bytes12 u;',
+    'uint200 a; uint64 b; uint56 c; bytes7 d; int8 e; uint120 f; uint136 g;',
+    'string s; bool b; uint24 c; address a;',
+    'uint248 m; byte n; bool o; uint8 p;',
+]
+
+
+def brute_force(variables):
+    """The original search: every permutation, fewest slots, ties broken alphabetically."""
+    permutations = [VariablesPermutation(permutation) for permutation in itertools.permutations(variables)]
+    winner = min(permutations, key=lambda p: (p.num_slots, tuple(var.name for var in p)))
+    return winner, max(p.num_slots for p in permutations)
+
+
+class PackVariablesTest(unittest.TestCase):
+    def test_matches_brute_force(self):
+        for struct in STRUCTS:
+            with self.subTest(struct=struct):
+                variables = parse_variables(struct)
+                winner, max_slots = pack_variables(variables)
+                expected_winner, expected_max_slots = brute_force(variables)
+                self.assertEqual([var.name for var in winner], [var.name for var in expected_winner])
+                self.assertEqual(winner.num_slots, expected_winner.num_slots)
+                self.assertEqual(max_slots, expected_max_slots)
+
+    def test_many_repeated_type_fields(self):
+        # only one DP state per number of uint8s taken, but the ordering search goes a level deeper per field
+        variables = [Variable('uint8', f'v{i:04d}') for i in range(3000)]
+        winner, max_slots = pack_variables(variables)
+        self.assertEqual(winner, VariablesPermutation(variables))
+        self.assertEqual(winner.num_slots, 94)
+        self.assertEqual(max_slots, 94)
+
+
+if __name__ == '__main__':
+    unittest.main()